@@ -13,27 +13,31 @@ The agent can now search the web, look up encyclopedia articles, and find academ
 # Streamlit: Framework for building web apps with Python
 import streamlit as st
 
-# os: For setting environment variables (API keys)
+# os: For building file paths (saved chat history)
 import os
 
-# ChatOpenAI: Connects to OpenAI's GPT models (like ChatGPT)
-from langchain_openai import ChatOpenAI
+# asyncio: For running asynchronous code (lets tools run concurrently)
+import asyncio
 
-# TavilySearchResults: Tool for searching the web
-from langchain_community.tools.tavily_search import TavilySearchResults
+# threading, queue: Run the shared event loop in the background and pass
+# streamed tokens back to the page
+import threading
+import queue
 
-# ✨ NEW: Wikipedia and ArXiv tools
-# WikipediaQueryRun: Tool for searching Wikipedia encyclopedia
-# ArxivQueryRun: Tool for searching academic papers on ArXiv
-from langchain_community.tools import WikipediaQueryRun, ArxivQueryRun
+# atexit: For closing network connections when the server shuts down
+import atexit
 
-# ✨ NEW: API wrappers for Wikipedia and ArXiv
-# WikipediaAPIWrapper: Handles Wikipedia API calls
-# ArxivAPIWrapper: Handles ArXiv API calls
-from langchain_community.utilities import WikipediaAPIWrapper, ArxivAPIWrapper
+# time: For limiting how often streamed text is pushed to the page
+import time
 
-# create_react_agent: Creates an agent that can reason and use tools
-from langgraph.prebuilt import create_react_agent
+# json, uuid: For saving chat history to disk under a random session id
+import json
+import uuid
+
+# LangChain, LangGraph and the search libraries take several seconds to
+# import. They are imported inside the functions that use them instead, so
+# the page (and the API key form) appears right away. Those functions are
+# cached, so the import cost is paid only once per server process.
 
 
 # =========================================================
@@ -50,6 +54,118 @@ st.title("🔍 Multi-Tool Chatbot Agent")
 st.caption("AI agent with web search, Wikipedia, and ArXiv capabilities")
 
 
+# =========================================================
+# SAVED CHAT HISTORY
+# =========================================================
+
+# Chat history is saved to disk so that refreshing the page (or opening the
+# same link in another tab) brings the conversation back without re-running
+# the agent. Each browser session is identified by a random "sid" value in
+# the page URL. Anyone with the link can see that chat.
+HISTORY_DIR = os.path.join(".streamlit", "chat_history")
+
+# Saved chats that haven't changed for this long are deleted
+HISTORY_MAX_AGE_DAYS = 30
+
+
+def get_session_id():
+    """Return this chat's id from the URL, creating one if needed"""
+    session_id = st.query_params.get("sid", "")
+    
+    # Only accept ids we generated ourselves (they become file names)
+    try:
+        return uuid.UUID(hex=session_id).hex
+    except ValueError:
+        return uuid.uuid4().hex
+
+
+def history_path(session_id):
+    """Return the file that stores this chat's history"""
+    return os.path.join(HISTORY_DIR, f"{session_id}.json")
+
+
+def load_history(session_id):
+    """Read a saved chat history, or start an empty one
+    
+    The history holds the messages plus the running summary of the older
+    ones, so a reload doesn't have to summarize the whole chat again.
+    """
+    history = {"messages": [], "summary": "", "summarized_count": 0}
+    
+    try:
+        with open(history_path(session_id), encoding="utf-8") as f:
+            saved = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return history
+    
+    # Older files hold only the list of messages
+    if isinstance(saved, list):
+        saved = {"messages": saved}
+    
+    history.update(saved)
+    return history
+
+
+def save_history(session_id, history):
+    """Write the chat history to disk"""
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    
+    # Write to a temporary file first so a crash never leaves half a file
+    path = history_path(session_id)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(history, f)
+    os.replace(path + ".tmp", path)
+
+
+@st.cache_resource
+def get_history_lock():
+    """Return one lock shared by every tab, so saves don't overlap"""
+    return threading.Lock()
+
+
+def append_history(session_id, new_messages, summary, summarized_count):
+    """Add messages to the saved chat history and return the whole history"""
+    
+    # Re-read the file first: another tab with the same link may have added
+    # messages since this tab loaded it, and they shouldn't be overwritten
+    with get_history_lock():
+        history = load_history(session_id)
+        history["messages"] += new_messages
+        
+        # Keep whichever summary covers more of the conversation
+        if summarized_count > history["summarized_count"]:
+            history["summary"] = summary
+            history["summarized_count"] = summarized_count
+        
+        save_history(session_id, history)
+    return history
+
+
+def use_history(history):
+    """Show a saved chat history (and its summary) on this page"""
+    st.session_state.agent_messages = history["messages"]
+    st.session_state.history_summary = history["summary"]
+    st.session_state.summarized_count = history["summarized_count"]
+
+
+def remove_old_histories():
+    """Delete saved chats that haven't been used for a long time"""
+    cutoff = time.time() - HISTORY_MAX_AGE_DAYS * 24 * 60 * 60
+    
+    try:
+        entries = list(os.scandir(HISTORY_DIR))
+    except FileNotFoundError:
+        return
+    
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            # Another session may have just removed or replaced it
+            pass
+
+
 # =========================================================
 # SESSION STATE
 # =========================================================
@@ -60,11 +176,25 @@ if "openai_key" not in st.session_state:
 if "tavily_key" not in st.session_state:
     st.session_state.tavily_key = ""  # Store Tavily API key
 
-if "agent" not in st.session_state:
-    st.session_state.agent = None  # Store the agent instance
+if "session_id" not in st.session_state:
+    st.session_state.session_id = get_session_id()  # Id of the saved chat
+    remove_old_histories()  # Tidy up once per new browser session
 
 if "agent_messages" not in st.session_state:
-    st.session_state.agent_messages = []  # Store chat history
+    # Store chat history, the summary of older messages and how many
+    # messages it covers (restored from disk after a page refresh)
+    use_history(load_history(st.session_state.session_id))
+
+if "batch_results" not in st.session_state:
+    st.session_state.batch_results = []  # Store the last batch evaluation
+
+if "history_limit" not in st.session_state:
+    st.session_state.history_limit = 50  # How many past messages to display
+
+# Keep the chat's id in the URL, putting it back if it was lost (for example
+# after visiting another page), so a refresh still finds the saved history
+if st.query_params.get("sid") != st.session_state.session_id:
+    st.query_params["sid"] = st.session_state.session_id
 
 
 # =========================================================
@@ -90,6 +220,10 @@ with st.sidebar:
         st.write("✅ **Tavily Search** - Web search")
         st.write("✅ **Wikipedia** - Encyclopedia")
         st.write("✅ **ArXiv** - Research papers")
+        st.write("✅ **Multi-Source Search** - All three at once")
+        
+        # Switch between chatting and running a file of test questions
+        st.toggle("Batch Eval", key="batch_mode")
     
     if st.session_state.openai_key or st.session_state.tavily_key:
         if st.button("Change API Keys"):
@@ -153,93 +287,760 @@ if keys_needed:
     st.stop()  # Don't show chat interface until connected
 
 
+# =========================================================
+# CACHED TOOLS
+# =========================================================
+
+# Wikipedia and ArXiv content barely changes within a day, so repeated
+# lookups are served from memory instead of going back over the network.
+# (Tavily is left uncached because web results should stay fresh.)
+
+# How much text a Wikipedia or ArXiv lookup returns, by type of question.
+# Quick facts get a short extract. Research questions get a longer one, so
+# the agent doesn't have to search again for the part that was cut off.
+DOC_CHARS_MAX = {
+    "factual": 500,
+    "research": 2000
+}
+
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    """Create one pooled HTTP session for all Wikipedia and ArXiv requests"""
+    
+    # requests, HTTPAdapter: HTTP session that keeps connections open
+    import requests
+    from requests.adapters import HTTPAdapter
+    
+    session = requests.Session()
+    
+    # Keep connections open so later lookups skip the TCP + TLS handshake
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@st.cache_resource(show_spinner=False)
+def get_search_apis():
+    """Create the Wikipedia and ArXiv API wrappers once, on the shared session"""
+    
+    # wikipedia, arxiv: The libraries behind the Wikipedia and ArXiv tools
+    import wikipedia
+    import arxiv
+    
+    # WikipediaAPIWrapper: Handles Wikipedia API calls
+    # ArxivAPIWrapper: Handles ArXiv API calls
+    from langchain_community.utilities import WikipediaAPIWrapper, ArxivAPIWrapper
+    
+    session = get_http_session()
+    
+    class SharedSessionSearch(arxiv.Search):
+        """ArXiv search that downloads results over the shared HTTP session"""
+        
+        def results(self, offset: int = 0):
+            # A fresh client keeps arxiv's per-client rate limiting as before,
+            # but it reuses our pooled session instead of opening a new one
+            client = arxiv.Client()
+            client._session = session
+            return client.results(self, offset=offset)
+    
+    wiki_api = WikipediaAPIWrapper(
+        top_k_results=2,  # Return top 2 results
+        doc_content_chars_max=max(DOC_CHARS_MAX.values())  # Longest extract we use
+    )
+    arxiv_api = ArxivAPIWrapper(
+        top_k_results=2,  # Return top 2 results
+        doc_content_chars_max=max(DOC_CHARS_MAX.values())  # Longest extract we use
+    )
+    
+    # The wikipedia package calls requests.get() for every request; send those
+    # calls through the shared session instead. Its default API address is
+    # plain http, which costs a redirect each time, so go straight to https.
+    wikipedia.wikipedia.requests = session
+    wikipedia.wikipedia.API_URL = wikipedia.wikipedia.API_URL.replace("http://", "https://", 1)
+    
+    # Make the ArXiv wrapper search through the shared session too
+    arxiv_api.arxiv_search = SharedSessionSearch
+    
+    return wiki_api, arxiv_api
+
+
+# Lookups always fetch the longest extract, and each tool cuts it down to
+# its own limit, so one cached result serves both kinds of question.
+
+@st.cache_data(ttl=86400, max_entries=512, show_spinner=False)
+def _wiki_run(query: str) -> str:
+    """Search Wikipedia, remembering results for a day"""
+    wiki_api, _ = get_search_apis()
+    return wiki_api.run(query)
+
+
+@st.cache_data(ttl=86400, max_entries=512, show_spinner=False)
+def _arxiv_run(query: str) -> str:
+    """Search ArXiv, remembering results for a day"""
+    _, arxiv_api = get_search_apis()
+    return arxiv_api.run(query)
+
+
+# =========================================================
+# ASYNC RUNTIME
+# =========================================================
+
+# Every OpenAI request reuses connections from one shared HTTP/2 pool, which
+# skips the TCP + TLS handshake on each call. Pooled connections belong to
+# the event loop that opened them. So a single long-lived event loop runs in
+# a background thread, and every session sends its async work to it.
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    """Start the event loop that all sessions share"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-event-loop", daemon=True).start()
+    return loop
+
+
+def start_async(coro):
+    """Start a coroutine on the shared event loop without waiting for it"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and wait for its result"""
+    return start_async(coro).result()
+
+
+@st.cache_resource(show_spinner=False)
+def get_http_client():
+    """Create the HTTP/2 client used for every OpenAI request"""
+    
+    # httpx: HTTP client that keeps connections to OpenAI open between requests
+    import httpx
+    
+    client = httpx.AsyncClient(
+        http2=True,  # Send concurrent requests over one connection
+        limits=httpx.Limits(max_keepalive_connections=20)  # Keep connections open for reuse
+    )
+    loop = get_event_loop()
+    
+    def close_client():
+        """Close open connections when the server shuts down"""
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(timeout=5)
+    
+    atexit.register(close_client)
+    return client
+
+
 # =========================================================
 # CREATE AGENT
 # =========================================================
 
-if not st.session_state.agent:
-    # Set API keys as environment variables (required by some tools)
-    os.environ["OPENAI_API_KEY"] = st.session_state.openai_key
-    os.environ["TAVILY_API_KEY"] = st.session_state.tavily_key
+# Description of each tool, keyed by tool name. The agent reads these to
+# decide which tool to call, and the tool router below matches questions
+# against them.
+TOOL_DESCRIPTIONS = {
+    "multi_search": """Search the web, Wikipedia and ArXiv at the same time and 
+        return all results together. Use this FIRST for broad questions needing 
+        multiple sources.""",
+    "tavily_search_results_json": """Search the web for current events, news, prices, 
+        and recent facts. Best for: 'Latest news on...', 'Current...', 
+        'What happened...' queries.""",
+    "wikipedia": """Search Wikipedia for encyclopedia articles, historical information, 
+        biographies, and general knowledge. Best for: 'Who was...', 'What is...', 
+        'History of...', 'Explain...' queries.""",
+    "arxiv": """Search ArXiv for academic papers, research articles, and scientific 
+        publications. Best for: 'Latest research on...', 'Papers about...', 
+        'Scientific studies on...' queries.""",
+}
+
+# Names of every tool the agent can use
+ALL_TOOLS = tuple(TOOL_DESCRIPTIONS)
+
+
+@st.cache_resource(show_spinner=False)
+def build_llm(openai_key: str, temperature: float = 0):
+    """Create a language model once and share it across sessions"""
     
-    # Create language model
-    llm = ChatOpenAI(
+    # ChatOpenAI: Connects to OpenAI's GPT models (like ChatGPT)
+    from langchain_openai import ChatOpenAI
+    
+    return ChatOpenAI(
         model="gpt-4o-mini",  # Use GPT-4o-mini (fast and cheap)
-        temperature=0  # 0 = deterministic, 1 = creative
+        temperature=temperature,  # 0 = deterministic, 1 = creative
+        streaming=True,  # Send the answer back token by token
+        api_key=openai_key,
+        http_async_client=get_http_client()  # Reuse pooled connections
     )
+
+
+@st.cache_resource(show_spinner=False)
+def build_agent(
+    openai_key: str,
+    tavily_key: str,
+    tool_names: tuple = ALL_TOOLS,
+    doc_chars_max: int = DOC_CHARS_MAX["factual"]
+):
+    """Create the LLM, tools and agent once and share them across sessions
+    
+    Only the tools listed in tool_names are given to the agent, and Wikipedia
+    and ArXiv results are cut to doc_chars_max characters. Each combination
+    is built once and then reused.
+    """
+    
+    # TavilySearchResults: Tool for searching the web
+    # TavilySearchAPIWrapper: Calls the Tavily API with the given key
+    from langchain_community.tools.tavily_search import TavilySearchResults
+    from langchain_community.utilities.tavily_search import TavilySearchAPIWrapper
+    
+    # ✨ NEW: Wikipedia and ArXiv tools
+    # WikipediaQueryRun: Tool for searching Wikipedia encyclopedia
+    # ArxivQueryRun: Tool for searching academic papers on ArXiv
+    from langchain_community.tools import WikipediaQueryRun, ArxivQueryRun
+    
+    # SystemMessage: Instructions for the model
+    from langchain_core.messages import SystemMessage
+    
+    # tool: Turns a Python function into a tool the agent can call
+    from langchain_core.tools import tool
+    
+    # LangGraph: For building the agent's workflow
+    # StateGraph: Tool for building workflows with state management
+    # START: Special marker for the workflow beginning
+    # add_messages: Appends new messages to the conversation state
+    from langgraph.graph import StateGraph, START
+    from langgraph.graph.message import add_messages
+    
+    # ToolNode: Runs the tools the model asked for (several at once if needed)
+    # tools_condition: Sends the workflow to the tools, or ends it when done
+    from langgraph.prebuilt import ToolNode, tools_condition
+    
+    # Type hints for the workflow state
+    from typing import Annotated
+    from typing_extensions import TypedDict
+    
+    # Wikipedia and ArXiv tools that answer repeated queries from the cache
+    class CachedWikipediaQueryRun(WikipediaQueryRun):
+        doc_chars_max: int
+        
+        def _run(self, query: str, run_manager=None) -> str:
+            return _wiki_run(query)[: self.doc_chars_max]
+    
+    class CachedArxivQueryRun(ArxivQueryRun):
+        doc_chars_max: int
+        
+        def _run(self, query: str, run_manager=None) -> str:
+            return _arxiv_run(query)[: self.doc_chars_max]
+    
+    # Create language model
+    llm = build_llm(openai_key)
+    
+    # Wikipedia and ArXiv API wrappers (shared with the cached lookups)
+    wiki_api, arxiv_api = get_search_apis()
     
     # Create Tavily search tool (for web search)
-    search_tool = TavilySearchResults(max_results=3)
+    # The key is passed in directly rather than through an environment
+    # variable, since agents for different users are built in the same process
+    search_tool = TavilySearchResults(
+        api_wrapper=TavilySearchAPIWrapper(tavily_api_key=tavily_key),
+        max_results=3,
+        description=TOOL_DESCRIPTIONS["tavily_search_results_json"]
+    )
     
     # ✨ NEW: Create Wikipedia tool (for encyclopedia articles)
-    wikipedia = WikipediaQueryRun(
-        api_wrapper=WikipediaAPIWrapper(
-            top_k_results=2,  # Return top 2 results
-            doc_content_chars_max=500  # Limit content length
-        ),
+    wikipedia = CachedWikipediaQueryRun(
+        api_wrapper=wiki_api,
+        doc_chars_max=doc_chars_max,
         name="wikipedia",
-        description="""Search Wikipedia for encyclopedia articles, historical information, 
-        biographies, and general knowledge. Best for: 'Who was...', 'What is...', 
-        'History of...', 'Explain...' queries."""
+        description=TOOL_DESCRIPTIONS["wikipedia"]
     )
     
     # ✨ NEW: Create ArXiv tool (for academic papers)
-    arxiv = ArxivQueryRun(
-        api_wrapper=ArxivAPIWrapper(
-            top_k_results=2,  # Return top 2 results
-            doc_content_chars_max=500  # Limit content length
-        ),
+    arxiv = CachedArxivQueryRun(
+        api_wrapper=arxiv_api,
+        doc_chars_max=doc_chars_max,
         name="arxiv",
-        description="""Search ArXiv for academic papers, research articles, and scientific 
-        publications. Best for: 'Latest research on...', 'Papers about...', 
-        'Scientific studies on...' queries."""
+        description=TOOL_DESCRIPTIONS["arxiv"]
+    )
+    
+    # Create multi-source tool (all three searches in one call)
+    @tool("multi_search", description=TOOL_DESCRIPTIONS["multi_search"])
+    async def multi_search(query: str) -> str:
+        """Run the web, Wikipedia and ArXiv searches concurrently"""
+        sources = {"Web": search_tool, "Wikipedia": wikipedia, "ArXiv": arxiv}
+        
+        # One failing source shouldn't hide the results of the others
+        results = await asyncio.gather(
+            *(source.ainvoke(query) for source in sources.values()),
+            return_exceptions=True
+        )
+        
+        sections = []
+        for title, result in zip(sources, results):
+            if isinstance(result, Exception):
+                result = f"❌ Error: {str(result)}"
+            sections.append(f"## {title}\n{result}")
+        return "\n\n".join(sections)
+    
+    # ✨ MODIFIED: Create agent with the requested tools
+    # (multi_search comes first so the model sees it before the others)
+    tools = [
+        t for t in [multi_search, search_tool, wikipedia, arxiv]
+        if t.name in tool_names
+    ]
+    
+    # Let the model request several tools in one turn (e.g. Wikipedia + ArXiv)
+    # instead of one tool per round trip; the agent then runs them together
+    llm_with_tools = llm.bind_tools(tools, parallel_tool_calls=True)
+    
+    # Instructions for the model. Tool calls come back as structured data,
+    # so ask it not to write any text before calling tools.
+    system_msg = SystemMessage(
+        content="Call tools directly, without describing what you are about to do. "
+        "When multiple independent lookups are needed, emit all tool calls in a single turn."
+    )
+    
+    # Define conversation state
+    class State(TypedDict):
+        messages: Annotated[list, add_messages]
+    
+    # Create agent node
+    async def agent_node(state: State):
+        """Ask the model for tool calls, or for the final answer"""
+        messages = [system_msg] + state["messages"]
+        response = await llm_with_tools.ainvoke(messages)
+        return {"messages": [response]}
+    
+    # Build workflow: agent -> tools -> agent ... until no tools are requested
+    workflow = StateGraph(State)
+    workflow.add_node("agent", agent_node)
+    workflow.add_node("tools", ToolNode(tools))
+    workflow.add_edge(START, "agent")
+    workflow.add_conditional_edges("agent", tools_condition)
+    workflow.add_edge("tools", "agent")
+    
+    return workflow.compile()
+
+
+# =========================================================
+# TOOL ROUTER
+# =========================================================
+
+# Every tool adds its schema and description to the prompt. Instead of
+# always sending all of them, pick the 2 tools whose descriptions are
+# most similar to the question. The same comparison also decides whether
+# the question is a quick fact or a research question (see DOC_CHARS_MAX).
+# The question is embedded in the background while the rest of the turn
+# is prepared, so routing adds (almost) no waiting of its own.
+
+# Give the agent this many tools in one turn
+ROUTER_MAX_TOOLS = 2
+
+# Example of each type of question, matched against the user's question
+QUESTION_TYPES = {
+    "factual": """Quick factual lookup: who, what, when, where or how many. 
+        Needs a short, specific answer.""",
+    "research": """In-depth research question: explain how something works, 
+        compare approaches, survey recent work or summarize papers in detail.""",
+}
+
+
+@st.cache_resource(show_spinner=False)
+def build_router(openai_key: str):
+    """Embed the tool and question-type descriptions once for all sessions"""
+    
+    # OpenAIEmbeddings: Converts text to vectors (numbers) for similarity search
+    from langchain_openai import OpenAIEmbeddings
+    
+    embeddings = OpenAIEmbeddings(
+        model="text-embedding-3-small",  # Small, fast embedding model
+        api_key=openai_key,
+        http_async_client=get_http_client()  # Reuse pooled connections
     )
+    descriptions = list(TOOL_DESCRIPTIONS.values()) + list(QUESTION_TYPES.values())
+    vectors = run_async(embeddings.aembed_documents(descriptions))
     
-    # ✨ MODIFIED: Create agent with all three tools
-    tools = [search_tool, wikipedia, arxiv]
-    st.session_state.agent = create_react_agent(llm, tools)
+    tool_vectors = dict(zip(TOOL_DESCRIPTIONS, vectors))
+    type_vectors = dict(zip(QUESTION_TYPES, vectors[len(TOOL_DESCRIPTIONS):]))
+    return embeddings, tool_vectors, type_vectors
+
+
+def similarity(a, b):
+    """Cosine similarity of two embeddings"""
+    # OpenAI embeddings have length 1, so the dot product is the cosine similarity
+    return sum(x * y for x, y in zip(a, b))
+
+
+def start_question_embedding(query: str):
+    """Start embedding the question in the background; returns a future"""
+    embeddings, _, _ = build_router(st.session_state.openai_key)
+    return start_async(embeddings.aembed_query(query))
+
+
+def route_question(query_vector):
+    """Return the tools to use and the result length for an embedded question"""
+    _, tool_vectors, type_vectors = build_router(st.session_state.openai_key)
+    
+    # Pick the question type the question is most similar to
+    question_type = max(
+        type_vectors,
+        key=lambda name: similarity(query_vector, type_vectors[name])
+    )
+    doc_chars_max = DOC_CHARS_MAX[question_type]
+    
+    scores = {
+        name: similarity(query_vector, vector)
+        for name, vector in tool_vectors.items()
+    }
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    selected = ranked[:ROUTER_MAX_TOOLS]
+    
+    # Keep the original order so each combination maps to one cached agent
+    return tuple(name for name in ALL_TOOLS if name in selected), doc_chars_max
 
 
 # =========================================================
-# DISPLAY CHAT HISTORY
+# CONVERSATION MEMORY
 # =========================================================
 
-for message in st.session_state.agent_messages:
-    with st.chat_message(message["role"]):
-        st.write(message["content"])
+# Only the most recent messages are sent to the agent word for word.
+# Anything older is folded into a short running summary, so the prompt
+# stays the same size no matter how long the conversation gets.
+MAX_CONTEXT_MESSAGES = 20
+
+# When the window overflows, keep this many messages and summarize the rest
+# (summarizing in batches avoids an extra LLM call on every turn)
+KEEP_RECENT_MESSAGES = 10
+
+# Most messages folded into the summary by one LLM call, so a long backlog
+# (e.g. an old chat reopened from disk) never makes one oversized prompt
+SUMMARY_SLICE_MESSAGES = 20
+
+
+def build_context(messages, events, status):
+    """Return the messages to send to the agent: a summary plus recent turns"""
+    
+    # Messages not yet covered by the summary
+    recent = messages[st.session_state.summarized_count:]
+    
+    if len(recent) > MAX_CONTEXT_MESSAGES:
+        older = recent[:-KEEP_RECENT_MESSAGES]
+        recent = recent[-KEEP_RECENT_MESSAGES:]
+        
+        with st.spinner("Summarizing earlier conversation..."):
+            llm = build_llm(st.session_state.openai_key)
+            
+            # Fold the older messages into the running summary, a slice at a
+            # time. Progress is kept after each slice, so a failed call
+            # doesn't have to redo the slices before it.
+            for start in range(0, len(older), SUMMARY_SLICE_MESSAGES):
+                batch = older[start:start + SUMMARY_SLICE_MESSAGES]
+                transcript = "\n".join(f"{m['role']}: {m['content']}" for m in batch)
+                prompt = (
+                    "Summarize concisely, keeping names, facts and open questions.\n\n"
+                    f"Summary so far:\n{st.session_state.history_summary or '(none)'}\n\n"
+                    f"New messages:\n{transcript}"
+                )
+                
+                summary_task = start_async(llm.ainvoke(prompt))
+                st.session_state.history_summary = wait_showing_note(summary_task, events, status).content
+                st.session_state.summarized_count += len(batch)
+    
+    if not st.session_state.history_summary:
+        return recent
+    
+    # Give the agent the summary before the recent messages
+    summary_message = {
+        "role": "system",
+        "content": f"Summary of the earlier conversation: {st.session_state.history_summary}"
+    }
+    return [summary_message] + recent
 
 
 # =========================================================
-# HANDLE USER INPUT
+# STREAM AGENT RESPONSE
 # =========================================================
 
-user_input = st.chat_input("Ask me anything...")
+# Push streamed text to the browser at most once every 50 ms.
+# Redrawing on every single token makes long answers sluggish.
+STREAM_FLUSH_SECONDS = 0.05
+
 
-if user_input:
-    # Add user message to chat history
-    st.session_state.agent_messages.append({
-        "role": "user",
-        "content": user_input
-    })
+async def stream_filler(llm, question, events):
+    """Stream a one-line note about what the agent is looking up"""
+    messages = [
+        ("system", "One short sentence describing what you're about to look up."),
+        ("human", question)
+    ]
     
-    # Display user message
-    with st.chat_message("user"):
-        st.write(user_input)
+    try:
+        text = ""
+        async for chunk in llm.astream(messages):
+            text += chunk.content
+            events.put(("filler", text))
+    except Exception:
+        # The note is only cosmetic; never let it break the real answer
+        pass
+
+
+def start_filler(question, events):
+    """Start writing the note in the background, before any other work"""
+    llm = build_llm(st.session_state.openai_key, temperature=0.7).bind(max_tokens=20)
+    return start_async(stream_filler(llm, question, events))
+
+
+def wait_showing_note(task, events, status):
+    """Wait for a background task, showing the note as it is written"""
+    while not task.done():
+        try:
+            kind, text = events.get(timeout=STREAM_FLUSH_SECONDS)
+        except queue.Empty:
+            continue
+        status.caption(text)
+    return task.result()
+
+
+async def stream_agent(agent, messages, events):
+    """Pass the agent's answer tokens to the page as they are generated"""
     
-    # Generate response using agent
-    with st.chat_message("assistant"):
-        with st.spinner("Searching and thinking..."):
-            # Invoke agent with all messages
-            response = st.session_state.agent.invoke({
-                "messages": st.session_state.agent_messages
+    # AIMessageChunk: A piece of the AI's answer, emitted while it is being written
+    from langchain_core.messages import AIMessageChunk
+    
+    try:
+        # astream runs the agent asynchronously, so tool calls requested in the
+        # same turn run concurrently instead of one after another.
+        # stream_mode="messages" emits (message_chunk, metadata) pairs
+        # as soon as the LLM produces each token
+        async for chunk, metadata in agent.astream(
+            {"messages": messages},
+            stream_mode="messages"
+        ):
+            # Only forward text written by the agent (skip tool results)
+            if (
+                isinstance(chunk, AIMessageChunk)
+                and metadata.get("langgraph_node") == "agent"
+                and chunk.content
+            ):
+                events.put(("answer", chunk.content))
+    
+    finally:
+        # Tell the page the answer is complete (or has failed)
+        events.put(("done", None))
+
+
+def stream_response(agent, messages, events, status, filler_task):
+    """Yield the agent's answer in small batches of tokens as it is generated"""
+    
+    # The shared event loop hands tokens back to this page through the same
+    # queue as the note, which keeps showing while tools run and is removed
+    # once the answer starts
+    agent_task = start_async(stream_agent(agent, messages, events))
+    answer_started = False
+    
+    # Tokens received since the last time we updated the page
+    buffer = []
+    last_flush = time.monotonic()
+    
+    try:
+        while True:
+            kind, text = events.get()
+            
+            if kind == "done":
+                break
+            
+            if kind == "filler":
+                # Keep showing the note until the real answer starts
+                if not answer_started:
+                    status.caption(text)
+                continue
+            
+            # The real answer has started: replace the note with it
+            if not answer_started:
+                answer_started = True
+                filler_task.cancel()
+                status.empty()
+            
+            buffer.append(text)
+            
+            # Send the batched tokens once enough time has passed
+            if time.monotonic() - last_flush >= STREAM_FLUSH_SECONDS:
+                yield "".join(buffer)
+                buffer.clear()
+                last_flush = time.monotonic()
+        
+        # Send whatever is left at the end of the answer
+        if buffer:
+            yield "".join(buffer)
+        
+        # Surface any error the agent ran into
+        agent_task.result()
+    
+    finally:
+        agent_task.cancel()
+
+
+# =========================================================
+# BATCH EVALUATION
+# =========================================================
+
+# Run many questions through the agent at once, e.g. to regression-test it
+# on a list of sample questions. Up to this many run at the same time.
+BATCH_MAX_CONCURRENCY = 10
+
+
+def batch_panel():
+    """Answer every question in an uploaded file and show the results"""
+    st.subheader("🧪 Batch Eval")
+    
+    uploaded_file = st.file_uploader(
+        "Questions file (one question per line)",
+        type=["txt"]
+    )
+    
+    if uploaded_file and st.button("Run Batch"):
+        # Read one question per line, skipping blank lines
+        # ("utf-8-sig" drops the byte-order mark some editors add)
+        try:
+            text = uploaded_file.getvalue().decode("utf-8-sig")
+        except UnicodeDecodeError:
+            st.error("❌ The questions file must be UTF-8 text")
+            return
+        questions = [line.strip() for line in text.splitlines() if line.strip()]
+        
+        if not questions:
+            st.warning("The questions file has no questions")
+            return
+        
+        # Use the agent with every tool so all questions are treated the same
+        agent = build_agent(
+            st.session_state.openai_key,
+            st.session_state.tavily_key
+        )
+        
+        with st.spinner(f"Answering {len(questions)} questions..."):
+            # abatch runs the questions concurrently; a failed question
+            # returns its error instead of stopping the whole batch
+            responses = run_async(agent.abatch(
+                [{"messages": [("user", question)]} for question in questions],
+                config={"max_concurrency": BATCH_MAX_CONCURRENCY},
+                return_exceptions=True
+            ))
+        
+        st.session_state.batch_results = []
+        for question, response in zip(questions, responses):
+            if isinstance(response, Exception):
+                answer = f"❌ Error: {str(response)}"
+            else:
+                answer = response["messages"][-1].content
+            
+            st.session_state.batch_results.append({
+                "Question": question,
+                "Answer": answer
             })
+    
+    if st.session_state.batch_results:
+        st.dataframe(st.session_state.batch_results)
+
+
+# =========================================================
+# CHAT PANEL
+# =========================================================
+
+# The chat lives in a fragment: sending a message reruns only this part of
+# the page, not the sidebar, key checks and agent setup above it.
+
+# Only the most recent messages are drawn; "Load earlier messages" shows
+# this many more each time it is clicked. Redrawing hundreds of old
+# messages on every rerun would make long chats slow.
+HISTORY_PAGE_SIZE = 50
+
+
+def show_earlier_messages():
+    """Display one more page of older messages"""
+    st.session_state.history_limit += HISTORY_PAGE_SIZE
+
+
+@st.fragment
+def chat_panel():
+    """Show the chat history and answer new messages"""
+    
+    messages = st.session_state.agent_messages
+    hidden_count = len(messages) - st.session_state.history_limit
+    
+    if hidden_count > 0:
+        st.button(
+            f"Load earlier messages ({hidden_count} hidden)",
+            on_click=show_earlier_messages
+        )
+    
+    # Display the most recent chat history
+    # (st.markdown skips the type detection st.write does for every call)
+    for message in messages[-st.session_state.history_limit:]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+    
+    # Handle user input
+    user_input = st.chat_input("Ask me anything...")
+    
+    if user_input:
+        # Add user message to chat history, saving it straight away so it
+        # is kept even if the answer fails
+        use_history(append_history(
+            st.session_state.session_id,
+            [{"role": "user", "content": user_input}],
+            st.session_state.history_summary,
+            st.session_state.summarized_count
+        ))
+        
+        # Display user message
+        with st.chat_message("user"):
+            st.markdown(user_input)
+        
+        # Generate response using agent
+        with st.chat_message("assistant"):
+            # Start the note about what is being looked up straight away, so
+            # the reply never sits blank while the question is prepared
+            events = queue.Queue()
+            status = st.empty()
+            filler_task = start_filler(user_input, events)
             
-            # Extract response text from agent output
-            response_text = response["messages"][-1].content
-            st.write(response_text)
+            try:
+                # Embed the question for the tool router in the background
+                embedding_task = start_question_embedding(user_input)
+                
+                # Meanwhile, send a summary of older turns plus the most recent messages
+                context = build_context(st.session_state.agent_messages, events, status)
+                
+                # Use an agent that only knows about the tools this question
+                # needs, with result lengths suited to the type of question
+                query_vector = wait_showing_note(embedding_task, events, status)
+                tool_names, doc_chars_max = route_question(query_vector)
+                agent = build_agent(
+                    st.session_state.openai_key,
+                    st.session_state.tavily_key,
+                    tool_names,
+                    doc_chars_max
+                )
+                
+                # Write the answer as it streams in
+                response_text = st.write_stream(
+                    stream_response(agent, context, events, status, filler_task)
+                )
             
-            # Add assistant response to chat history
-            st.session_state.agent_messages.append({
-                "role": "assistant",
-                "content": response_text
-            })
\ No newline at end of file
+            finally:
+                filler_task.cancel()
+                status.empty()
+            
+            # Save the answer so a page refresh doesn't lose it, keeping
+            # anything other tabs have saved in the meantime
+            use_history(append_history(
+                st.session_state.session_id,
+                [{"role": "assistant", "content": response_text}],
+                st.session_state.history_summary,
+                st.session_state.summarized_count
+            ))
+
+
+# Show the batch tools or the chat, depending on the sidebar toggle
+if st.session_state.get("batch_mode"):
+    batch_panel()
+else:
+    chat_panel()
\ No newline at end of file